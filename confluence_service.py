@@ -1,8 +1,38 @@
 import os
+import logging
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from fastapi import HTTPException
 from models.confluence_models import ConfluenceEventInput, ConfluencePageCommentInput
+from resilience import resilient_request
+from state_backend import backend, cached_call
+
+logging.basicConfig(level=logging.INFO, filename="log.log")
+logger = logging.getLogger(__name__)
+
+# Parallel requests (and pooled connections) used by calendar sync
+CALENDAR_SYNC_CONCURRENCY = int(os.getenv("CONFLUENCE_SYNC_CONCURRENCY", "8"))
+# Seconds subcalendar and event listings are reused
+CALENDAR_CACHE_TTL = float(os.getenv("CONFLUENCE_CALENDAR_CACHE_TTL", "300"))
+
+_calendar_session = requests.Session()
+_calendar_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=CALENDAR_SYNC_CONCURRENCY))
+_calendar_session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=CALENDAR_SYNC_CONCURRENCY))
+
+def _calendar_event_payload(event: ConfluenceEventInput) -> dict:
+    return {
+        "subCalendarId": event.calendar_id,
+        "eventType": "single",
+        "title": event.title,
+        "start": event.start,
+        "end": event.end,
+        "description": event.description,
+        "type": "event"
+    }
 
 def add_event_to_calendar(event: ConfluenceEventInput):
     """
@@ -18,19 +48,12 @@ def add_event_to_calendar(event: ConfluenceEventInput):
         "Content-Type": "application/json",
         "Accept": "application/json"
     }
-    payload = {
-        "subCalendarId": event.calendar_id,
-        "eventType": "single",
-        "title": event.title,
-        "start": event.start,
-        "end": event.end,
-        "description": event.description,
-        "type": "event"
-    }
-    response = requests.post(url, json=payload, headers=headers)
+    payload = _calendar_event_payload(event)
+    response = resilient_request("POST", url, session=_calendar_session, json=payload, headers=headers)
     if not response.ok:
         #return response.status_code
         raise HTTPException(status_code=response.status_code, detail=response.text)
+    _invalidate_calendar_events(event.calendar_id)
     return response.json()
 
 def get_confluence_page(page_id: str):
@@ -44,15 +67,17 @@ def get_confluence_page(page_id: str):
         "Authorization": f"Bearer {api_token}",
         "Accept": "application/json"
     }
-    response = requests.get(url, headers=headers)
+    response = resilient_request("GET", url, hedge=True, headers=headers)
     if not response.ok:
         raise HTTPException(status_code=response.status_code, detail=response.text)
     return response.json()
 
 
-def list_confluence_calendars():
+def list_confluence_calendars(refresh: bool = False):
     """
     List all available Confluence Team Calendars for the authenticated user.
+
+    The listing is cached for CONFLUENCE_CALENDAR_CACHE_TTL seconds unless refresh is set.
     """
     base_url = os.getenv("CONFLUENCE_BASE_URL")
     api_token = os.getenv("CONFLUENCE_API_TOKEN")
@@ -64,10 +89,16 @@ def list_confluence_calendars():
         "Authorization": f"Bearer {api_token}",
         "Accept": "application/json"
     }
-    response = requests.get(url, headers=headers)
-    if not response.ok:
-        raise HTTPException(status_code=response.status_code, detail=response.text)
-    return response.json()
+
+    def fetch():
+        response = resilient_request("GET", url, hedge=True, session=_calendar_session, headers=headers)
+        if not response.ok:
+            raise HTTPException(status_code=response.status_code, detail=response.text)
+        return response.json()
+
+    if refresh:
+        backend.delete("confluence:subcalendars")
+    return cached_call("confluence:subcalendars", fetch, ttl=CALENDAR_CACHE_TTL)
 
 
 def add_comment_to_confluence_page(page_id: str, comment: str):
@@ -99,7 +130,7 @@ def add_comment_to_confluence_page(page_id: str, comment: str):
         }
     }
 
-    response = requests.post(url, json=payload, headers=headers)
+    response = resilient_request("POST", url, json=payload, headers=headers)
     if not response.ok:
         
         raise HTTPException(status_code=response.status_code, detail=response.text)
@@ -120,7 +151,7 @@ def get_confluence_page_comments(page_id: str):
         "Authorization": f"Bearer {api_token}",
         "Accept": "application/json"
     }
-    response = requests.get(url, headers=headers)
+    response = resilient_request("GET", url, hedge=True, headers=headers)
     if not response.ok:
         raise HTTPException(status_code=response.status_code, detail=response.text)
     return response.json()
@@ -143,7 +174,184 @@ def get_confluence_footer_comments(page_id: str):
         #"Authorization": f"Bearer {api_token}",
         "Accept": "application/json"
     }
-    response = requests.get(url, headers=headers, auth=auth)
+    response = resilient_request("GET", url, hedge=True, headers=headers, auth=auth)
+    if not response.ok:
+        raise HTTPException(status_code=response.status_code, detail=response.text)
+    return response.json()
+
+def _calendar_config():
+    base_url = os.getenv("CONFLUENCE_BASE_URL")
+    api_token = os.getenv("CONFLUENCE_API_TOKEN")
+    if not base_url or not api_token:
+        raise RuntimeError("Confluence credentials are not configured")
+    url = f"{base_url}/rest/calendar-services/1.0/calendar/events.json"
+    headers = {
+        "Authorization": f"Bearer {api_token}",
+        "Content-Type": "application/json",
+        "Accept": "application/json"
+    }
+    return url, headers
+
+
+def _invalidate_calendar_events(calendar_id: str):
+    # Listings of any window of this subcalendar are stale after a write
+    for key in backend.keys(f"confluence:events:{calendar_id}:"):
+        if not key.endswith(":inflight"):
+            backend.delete(key)
+
+
+def get_calendar_events(calendar_id: str, start: str, end: str, refresh: bool = False) -> List[dict]:
+    """
+    List the events of a subcalendar between start and end (ISO format).
+
+    The listing is cached for CONFLUENCE_CALENDAR_CACHE_TTL seconds unless refresh is set.
+    """
+    url, headers = _calendar_config()
+    cache_key = f"confluence:events:{calendar_id}:{start}:{end}"
+
+    def fetch():
+        params = {"subCalendarId": calendar_id, "start": start, "end": end, "userTimeZoneId": "UTC"}
+        response = resilient_request("GET", url, hedge=True, session=_calendar_session, params=params, headers=headers)
+        if not response.ok:
+            raise HTTPException(status_code=response.status_code, detail=response.text)
+        return response.json().get("events", [])
+
+    if refresh:
+        backend.delete(cache_key)
+    return cached_call(cache_key, fetch, ttl=CALENDAR_CACHE_TTL)
+
+
+def update_calendar_event(uid: str, event: ConfluenceEventInput):
+    """
+    Update an existing event of a Confluence Team Calendar.
+    """
+    url, headers = _calendar_config()
+    payload = {**_calendar_event_payload(event), "uid": uid}
+    response = resilient_request("PUT", url, session=_calendar_session, json=payload, headers=headers)
     if not response.ok:
         raise HTTPException(status_code=response.status_code, detail=response.text)
-    return response.json()
\ No newline at end of file
+    _invalidate_calendar_events(event.calendar_id)
+    return response.json()
+
+
+def delete_calendar_event(calendar_id: str, uid: str):
+    """
+    Delete an event from a Confluence Team Calendar.
+    """
+    url, headers = _calendar_config()
+    params = {"subCalendarId": calendar_id, "uid": uid}
+    response = resilient_request("DELETE", url, session=_calendar_session, params=params, headers=headers)
+    if not response.ok:
+        raise HTTPException(status_code=response.status_code, detail=response.text)
+    _invalidate_calendar_events(calendar_id)
+    return {"uid": uid, "deleted": True}
+
+
+def _parse_time(value: Optional[str]):
+    """
+    An ISO time as an aware UTC datetime, or the raw value if it does not parse.
+
+    Naive times are taken as UTC, like the listing, which is requested with
+    userTimeZoneId=UTC; so "2024-05-01T22:00:00" equals "2024-05-01T22:00:00Z".
+    """
+    try:
+        parsed = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return value
+    return parsed.astimezone(timezone.utc) if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _sync_window(events: List[ConfluenceEventInput]):
+    """
+    Earliest start and latest end of the events, as UTC timestamps.
+
+    Compared as datetimes, not strings, so offsets and precision don't matter.
+    """
+    times = []
+    for event in events:
+        for value in (event.start, event.end):
+            parsed = _parse_time(value)
+            if not isinstance(parsed, datetime):
+                raise HTTPException(status_code=400, detail=f"Invalid ISO time for '{event.title}': {value}")
+            times.append(parsed)
+    return min(times).strftime("%Y-%m-%dT%H:%M:%SZ"), max(times).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _event_changed(existing: dict, event: ConfluenceEventInput) -> bool:
+    return (
+        _parse_time(existing.get("start")) != _parse_time(event.start)
+        or _parse_time(existing.get("end")) != _parse_time(event.end)
+        or (existing.get("description") or "") != (event.description or "")
+    )
+
+
+def sync_calendar_events(calendar_id: str, events: List[ConfluenceEventInput],
+                         delete_missing: bool = False, dry_run: bool = False) -> dict:
+    """
+    Bring a subcalendar in line with a batch of events.
+
+    Existing events between the earliest start and the latest end of the batch
+    are matched by title (and start, when a title repeats in the batch).
+    Only new events are created and only changed ones updated; with
+    delete_missing, unmatched existing events in that window are deleted.
+    Requests run concurrently over a pooled session.
+    """
+    if not events:
+        return {"calendar_id": calendar_id, "created": [], "updated": [], "deleted": [], "unchanged": 0, "errors": []}
+
+    title_counts = {}
+    for event in events:
+        title_counts[event.title] = title_counts.get(event.title, 0) + 1
+
+    def identity(title: str, start: Optional[str]):
+        return title if title_counts.get(title, 0) <= 1 else (title, _parse_time(start))
+
+    start, end = _sync_window(events)
+    existing_by_key = {}
+    # Always diff against the live calendar; it may have been edited in Confluence itself
+    for existing in get_calendar_events(calendar_id, start, end, refresh=True):
+        existing_by_key.setdefault(identity(existing.get("title"), existing.get("start")), []).append(existing)
+
+    operations, unchanged = [], 0
+    for event in events:
+        matches = existing_by_key.get(identity(event.title, event.start))
+        if not matches:
+            operations.append(("created", event.title, add_event_to_calendar, (event,)))
+            continue
+        existing = matches.pop(0)
+        if _event_changed(existing, event):
+            uid = existing.get("id") or existing.get("uid")
+            operations.append(("updated", event.title, update_calendar_event, (uid, event)))
+        else:
+            unchanged += 1
+    if delete_missing:
+        for leftovers in existing_by_key.values():
+            for existing in leftovers:
+                uid = existing.get("id") or existing.get("uid")
+                operations.append(("deleted", existing.get("title"), delete_calendar_event, (calendar_id, uid)))
+
+    result = {"calendar_id": calendar_id, "created": [], "updated": [], "deleted": [], "unchanged": unchanged, "errors": []}
+    if dry_run:
+        for action, title, _, _ in operations:
+            result[action].append(title)
+        return result
+
+    def run(operation):
+        action, title, fn, args = operation
+        try:
+            fn(*args)
+            return action, title, None
+        except Exception as e:
+            logger.error(f"Calendar sync failed to {action[:-1]} event '{title}': {str(e)}")
+            return action, title, str(e)
+
+    with ThreadPoolExecutor(max_workers=CALENDAR_SYNC_CONCURRENCY) as pool:
+        for action, title, error in pool.map(run, operations):
+            if error:
+                result["errors"].append({"action": action, "title": title, "error": error})
+            else:
+                result[action].append(title)
+
+    logger.info(f"Calendar {calendar_id} synced: {len(result['created'])} created, {len(result['updated'])} updated, "
+                f"{len(result['deleted'])} deleted, {unchanged} unchanged, {len(result['errors'])} errors")
+    return result
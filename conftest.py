@@ -0,0 +1,17 @@
+import os
+
+import pytest
+
+# The service modules create their clients from the environment at import time
+os.environ.setdefault("TESTRAIL_BASE_URL", "https://testrail.example.com")
+os.environ.setdefault("TESTRAIL_EMAIL", "tests@example.com")
+os.environ.setdefault("TESTRAIL_PASSWORD", "secret")
+os.environ["STATE_BACKEND"] = "memory"
+
+
+@pytest.fixture(autouse=True)
+def clean_backend():
+    from state_backend import backend
+    yield
+    for key in backend.keys():
+        backend.delete(key)
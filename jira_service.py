@@ -1,6 +1,6 @@
 import os
-import requests
 from fastapi import HTTPException
+from resilience import resilient_request
 
 def fetch_issue_from_jira(issue_key: str):
     """
@@ -25,7 +25,7 @@ def fetch_issue_from_jira(issue_key: str):
         "Authorization": f"Bearer {api_token}",
         "Accept": "application/json"
     }
-    response = requests.get(url, headers=headers)
+    response = resilient_request("GET", url, hedge=True, headers=headers)
     response.raise_for_status()
     data = response.json()
     user_story = data["fields"].get("description", "")
@@ -56,7 +56,7 @@ def add_comment_to_jira(issue_key: str, comment: str):
         "Accept": "application/json"
     }
     payload = {"body": comment}
-    response = requests.post(url, json=payload, headers=headers)
+    response = resilient_request("POST", url, json=payload, headers=headers)
     if not response.ok:
         raise HTTPException(status_code=response.status_code, detail=response.text)
     return response.json()
\ No newline at end of file
@@ -0,0 +1,245 @@
+import os
+import re
+import difflib
+import logging
+import uuid
+import threading
+from typing import List
+
+from ollama_service import generate_test_cases_ollama
+from ollama_scheduler import PRIORITY_BATCH
+from testrail_service import build_test_case_payload, post_test_case_to_testrail, update_test_case_in_testrail
+from state_backend import backend, WORKER_ID
+
+logging.basicConfig(level=logging.INFO, filename="log.log")
+logger = logging.getLogger(__name__)
+
+# Seconds to wait after the last edit of an issue before regenerating
+DEBOUNCE_SECONDS = float(os.getenv("JIRA_WEBHOOK_DEBOUNCE_SECONDS", "30"))
+
+# Upper bound for one regeneration; a crashed worker's lock expires after this
+PROCESSING_LOCK_TTL = float(os.getenv("JIRA_WEBHOOK_LOCK_TTL", "900"))
+# Attempts per pending update before it is dropped (e.g. while Ollama is saturated)
+MAX_ATTEMPTS = int(os.getenv("JIRA_WEBHOOK_MAX_ATTEMPTS", "3"))
+
+# Debounce timers are local to the worker that received the event. The latest
+# pending description, the processed state and the per-issue lock live in the
+# shared backend, so any worker may receive the next event.
+_lock = threading.Lock()
+_timers = {}          # issue_key -> pending threading.Timer
+
+
+def _pending_key(issue_key: str) -> str:
+    return f"jira:pending:{issue_key}"       # {"description": str, "version": str, "attempts": int}
+
+
+def _processed_key(issue_key: str) -> str:
+    # {"description": str, "criteria": [{"text": str, "case_ids": [int]}], "unattributed_case_ids": [int]}
+    return f"jira:processed:{issue_key}"
+
+
+_CRITERIA_HEADER = re.compile(r"acceptance\s+criteria", re.IGNORECASE)
+_LIST_MARKER = re.compile(r"^\s*(?:[*#\-•]+|\d+[.)]|AC\s*\d+[:.)]?)\s+", re.IGNORECASE)
+
+
+def split_acceptance_criteria(description: str) -> List[str]:
+    """
+    Split an issue description into individual acceptance criteria.
+
+    Lines after an "Acceptance Criteria" heading are used if present, otherwise
+    the whole description. List items become one criterion each; plain lines
+    are appended to the preceding item.
+    """
+    if not description:
+        return []
+    lines = description.splitlines()
+    for index, line in enumerate(lines):
+        if _CRITERIA_HEADER.search(line):
+            lines = lines[index + 1:]
+            break
+
+    criteria = []
+    for line in lines:
+        text = line.strip()
+        if not text:
+            continue
+        if _LIST_MARKER.match(line) or not criteria:
+            criteria.append(_LIST_MARKER.sub("", line).strip())
+        else:
+            criteria[-1] = f"{criteria[-1]} {text}"
+    return [criterion for criterion in criteria if criterion]
+
+
+def record_processed_issue(issue_key: str, description: str, case_ids: List[int]):
+    """
+    Remember the description test cases were last generated from.
+
+    Used by the full /generate-test-cases/ run so later webhook events only
+    regenerate what changed afterwards. Cases generated there cannot be
+    attributed to a single criterion; they are kept as "unattributed" and
+    are not updated by later edits, so changed criteria get additional cases.
+    """
+    backend.set(_processed_key(issue_key), {
+        "description": description,
+        "criteria": [{"text": text, "case_ids": []} for text in split_acceptance_criteria(description)],
+        "unattributed_case_ids": case_ids,
+    })
+    logger.info(f"Recorded processed description for {issue_key}")
+
+
+def unattributed_case_ids(issue_key: str) -> List[int]:
+    """
+    Case ids from a full generation that webhook updates do not touch.
+    """
+    processed = backend.get(_processed_key(issue_key)) or {}
+    return processed.get("unattributed_case_ids", [])
+
+
+def _start_timer(issue_key: str, version: str):
+    with _lock:
+        timer = _timers.pop(issue_key, None)
+        if timer:
+            timer.cancel()
+        timer = threading.Timer(DEBOUNCE_SECONDS, _run_pending_update, args=(issue_key, version))
+        timer.daemon = True
+        _timers[issue_key] = timer
+        timer.start()
+
+
+def schedule_issue_update(issue_key: str, description: str) -> str:
+    """
+    Debounce an issue update: (re)start the timer for the issue and keep only the latest description.
+    """
+    previous = backend.get(_processed_key(issue_key))
+    if backend.get(_pending_key(issue_key)) is None and previous and previous["description"] == description:
+        return "unchanged"
+    version = uuid.uuid4().hex
+    backend.set(_pending_key(issue_key), {"description": description, "version": version})
+    _start_timer(issue_key, version)
+    logger.info(f"Scheduled regeneration for {issue_key} in {DEBOUNCE_SECONDS}s")
+    return "scheduled"
+
+
+def _run_pending_update(issue_key: str, version: str):
+    with _lock:
+        _timers.pop(issue_key, None)
+    pending = backend.get(_pending_key(issue_key))
+    if not pending or pending["version"] != version:
+        # Superseded by a newer event, possibly received by another worker
+        return
+    lock_key = f"jira:processing:{issue_key}"
+    if not backend.add(lock_key, WORKER_ID, ttl=PROCESSING_LOCK_TTL):
+        # Another regeneration of this issue is running; try again after it
+        _start_timer(issue_key, version)
+        return
+    try:
+        process_issue_update(issue_key, pending["description"])
+        current = backend.get(_pending_key(issue_key))
+        if current and current["version"] == version:
+            backend.delete(_pending_key(issue_key))
+    except Exception as e:
+        attempts = pending.get("attempts", 0) + 1
+        if attempts < MAX_ATTEMPTS:
+            logger.error(f"Failed to process update for {issue_key} (attempt {attempts}), retrying: {str(e)}")
+            # Keep the event pending; a newer event replaces it anyway
+            if backend.get(_pending_key(issue_key)) == pending:
+                backend.set(_pending_key(issue_key), {**pending, "attempts": attempts})
+                _start_timer(issue_key, version)
+        else:
+            logger.error(f"Giving up on update for {issue_key} after {attempts} attempts: {str(e)}")
+            backend.delete(_pending_key(issue_key))
+    finally:
+        backend.delete(lock_key)
+
+
+def _generate_for_criterion(description: str, criterion: str) -> List[dict]:
+    cases = generate_test_cases_ollama(description, priority=PRIORITY_BATCH, criterion=criterion)
+    return [case for case in cases if isinstance(case, dict)]
+
+
+def _sync_criterion_cases(description: str, criterion: str, old_case_ids: List[int], case_ids: List[int]):
+    """
+    Regenerate test cases for one criterion; update its existing cases in place and add the rest.
+
+    Ids are appended to `case_ids` as they are written, so the caller still
+    knows them when a later case fails. A generation without any parsable
+    case raises, so the criterion is retried and keeps its old cases.
+    """
+    cases = _generate_for_criterion(description, criterion)
+    if not cases:
+        raise ValueError(f"No test cases generated for criterion: {criterion}")
+    for index, case in enumerate(cases):
+        payload = build_test_case_payload(case)
+        if index < len(old_case_ids):
+            update_test_case_in_testrail(old_case_ids[index], payload)
+            case_ids.append(old_case_ids[index])
+        else:
+            response = post_test_case_to_testrail(payload)
+            case_ids.append(response.get("id"))
+    stale = old_case_ids[len(case_ids):]
+    if stale:
+        # Kept in TestRail for a human to review, just no longer tracked
+        logger.warning(f"Cases {stale} are no longer generated for criterion: {criterion}")
+
+
+def process_issue_update(issue_key: str, description: str) -> dict:
+    """
+    Diff the description against the last processed version and regenerate
+    test cases only for added or changed acceptance criteria.
+
+    The state is saved after every criterion. If a criterion fails, the
+    previous description is kept so a retry redoes only the unfinished
+    criteria and reuses the cases already written for them.
+    """
+    previous = backend.get(_processed_key(issue_key)) or {"description": "", "criteria": []}
+    old_criteria = previous["criteria"]
+    new_texts = split_acceptance_criteria(description)
+
+    def save(done: List[dict], old_pos: int, finished: bool):
+        backend.set(_processed_key(issue_key), {
+            **previous,
+            "description": description if finished else previous["description"],
+            "criteria": done if finished else done + old_criteria[old_pos:],
+        })
+
+    matcher = difflib.SequenceMatcher(None, [c["text"] for c in old_criteria], new_texts, autojunk=False)
+    criteria = []
+    old_pos = 0  # old criteria before this index are replaced by entries in `criteria`
+    summary = {"unchanged": 0, "added": 0, "changed": 0, "removed": 0}
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            criteria.extend(old_criteria[i1:i2])
+            old_pos = i2
+            summary["unchanged"] += i2 - i1
+            continue
+        old_block = old_criteria[i1:i2]
+        for offset, text in enumerate(new_texts[j1:j2]):
+            # Pair replaced criteria positionally so their cases are updated, not duplicated
+            paired = offset < len(old_block)
+            old_ids = old_block[offset]["case_ids"] if paired else []
+            case_ids = []
+            try:
+                _sync_criterion_cases(description, text, old_ids, case_ids)
+            except Exception:
+                if paired:
+                    old_pos = i1 + offset + 1
+                # The marker text never matches the new criterion, so a retry
+                # pairs this entry with it again and updates these cases in place
+                criteria.append({"text": f"(incomplete) {text}", "case_ids": case_ids + old_ids[len(case_ids):]})
+                save(criteria, old_pos, finished=False)
+                raise
+            if paired:
+                old_pos = i1 + offset + 1
+            summary["changed" if paired else "added"] += 1
+            criteria.append({"text": text, "case_ids": case_ids})
+            save(criteria, old_pos, finished=False)
+        for removed in old_block[j2 - j1:]:
+            summary["removed"] += 1
+            logger.warning(f"Criterion removed from {issue_key}, cases {removed['case_ids']} left untouched: {removed['text']}")
+        old_pos = i2
+
+    save(criteria, old_pos, finished=True)
+    if previous.get("unattributed_case_ids") and (summary["added"] or summary["changed"]):
+        logger.warning(f"{issue_key}: cases {previous['unattributed_case_ids']} from the full generation were not updated")
+    logger.info(f"Processed update for {issue_key}: {summary}")
+    return summary
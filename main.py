@@ -1,6 +1,8 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field
 from typing import List, Tuple, Optional
+from datetime import datetime
 import os
 import dotenv
 dotenv.load_dotenv()
@@ -16,15 +18,26 @@ from confluence_service import list_confluence_calendars
 from confluence_service import add_comment_to_confluence_page
 from confluence_service import get_confluence_page_comments
 from confluence_service import get_confluence_footer_comments
+from confluence_service import sync_calendar_events
 
-from models.jira_models import IssueKeyInput, JiraCommentInput
-from models.confluence_models import ConfluenceEventInput, ConfluencePageCommentInput
+from models.jira_models import IssueKeyInput, JiraCommentInput, JiraWebhookEvent
+from models.confluence_models import ConfluenceEventInput, ConfluencePageCommentInput, ConfluenceCalendarSyncInput
 from ollama_service import  ollama_generate_prompt, ollama_healthcheck, generate_test_cases_ollama, generate_test_cases_ollama_prompt_test
+from ollama_service import DEFAULT_OUTPUT_FORMAT
+from ollama_scheduler import scheduler, PRIORITY_INTERACTIVE
 
 from testrail_service import post_test_case_to_testrail
 from testrail_service import get_testrail_case
 from testrail_service import StepSeparated
 from testrail_service import TestCasePayload
+from testrail_service import build_test_case_payload
+from testrail_service import create_test_run, add_test_results
+from testrail_service import DEFAULT_PROJECT_ID, DEFAULT_SUITE_ID
+from test_results import collect_results
+
+from jira_webhook import record_processed_issue, schedule_issue_update, unattributed_case_ids
+from prompt_experiments import start_experiment, replay_experiment, get_experiment
+from resilience import breaker_states
 
 import logging
 logging.basicConfig(level=logging.INFO, filename="log.log")
@@ -73,60 +86,86 @@ Each scenario should be concise and map to a single acceptance criterion or logi
 
 
 @app.post("/generate-test-cases/")
-async def generate_cases(input_data: IssueKeyInput, mock: bool = DEFAULT_MOCK):
+def generate_cases(input_data: IssueKeyInput, mock: bool = DEFAULT_MOCK, output_format: str = DEFAULT_OUTPUT_FORMAT):
     """
     Generate test cases for a JIRA issue and add them as a comment to the issue.
     """
     user_story = fetch_issue_from_jira(input_data.issue_key)
     #test_cases = generate_test_cases(user_story, mock=mock)
-    test_cases = generate_test_cases_ollama(user_story)
+    test_cases = generate_test_cases_ollama(user_story, output_format=output_format)
 
+    testrail_responses, failed_cases = [], []
     for case in test_cases:
         #Convert the test case to a TestCasePayload object with custom_steps_separated as StepSeparated objects
         if isinstance(case, dict):
-            custom_steps_separated = [
-                StepSeparated(content=step["content"], expected=step.get("expected", ""))
-                for step in case.get("custom_steps_separated", [])
-            ]
-            case_payload = TestCasePayload(
-                project_id=1047,
-                suite_id=1409,
-                section_id=12172,
-                title=case.get("title"),
-                custom_steps=case.get("custom_steps", ""),
-                custom_steps_separated=custom_steps_separated,
-                automation_type=case.get("automation_type", 0),
-                custom_preconds=case.get("custom_preconds", None),
-                custom_ispositive=case.get("custom_ispositive", 0),
-                priority_id=case.get("priority_id", 2),
-                type_id=case.get("type_id", None)
-            )
-            # Post the test case to TestRail
+            case_payload = build_test_case_payload(case)
+            # Post the test case to TestRail; one failing case must not discard the rest of the generation
             try:
-                testrail_response = post_test_case_to_testrail(case_payload)
+                testrail_responses.append(post_test_case_to_testrail(case_payload))
             except Exception as e:
                 logger.error(f"Failed to add test case to TestRail: {str(e)}")
-                raise HTTPException(status_code=500, detail=f"Failed to add test case to TestRail: {str(e)}")
-    logger.info(f"Generated test cases: {testrail_response}")
-    
-    #logger.info(f"The test_cases: {test_cases}")
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    comment = f"Test Cases are generated and added to TestRail on {timestamp}. Please review them, and do necessary updates if needed."
-    result = add_comment_to_jira(input_data.issue_key, comment)
+                failed_cases.append({"case": case, "error": str(e)})
+    logger.info(f"Generated test cases: {testrail_responses}")
+
+    result = None
+    if testrail_responses:
+        record_processed_issue(
+            input_data.issue_key, user_story, [response.get("id") for response in testrail_responses]
+        )
+        #logger.info(f"The test_cases: {test_cases}")
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        comment = f"Test Cases are generated and added to TestRail on {timestamp}. Please review them, and do necessary updates if needed."
+        try:
+            result = add_comment_to_jira(input_data.issue_key, comment)
+        except Exception as e:
+            logger.error(f"Failed to add comment to JIRA: {str(e)}")
+            result = {"error": str(e)}
     
     #add test trail 
-    return {"issue_key": input_data.issue_key, "action":result, "generated_test_cases": test_cases, "testrail_response": testrail_response}
+    return {"issue_key": input_data.issue_key, "action":result, "generated_test_cases": test_cases,
+            "testrail_response": testrail_responses, "failed_cases": failed_cases}
 
 @app.post("/add-comment/")
-async def add_comment(input_data: JiraCommentInput):
+def add_comment(input_data: JiraCommentInput):
     """
     Add a comment to a JIRA issue.
     """
     result = add_comment_to_jira(input_data.issue_key, input_data.comment)
     return {"issue_key": input_data.issue_key, "comment_added": True, "jira_response": result}
 
+@app.post("/jira/webhook")
+def jira_webhook(event: JiraWebhookEvent, secret: Optional[str] = None):
+    """
+    Receive Jira issue-updated events and schedule a debounced, incremental
+    regeneration of test cases for the changed acceptance criteria.
+    """
+    expected_secret = os.getenv("JIRA_WEBHOOK_SECRET")
+    if expected_secret and secret != expected_secret:
+        raise HTTPException(status_code=401, detail="Invalid webhook secret")
+    if event.webhookEvent != "jira:issue_updated":
+        return {"status": "ignored", "reason": f"Unsupported event {event.webhookEvent}"}
+
+    issue_key = event.issue.get("key")
+    if not issue_key:
+        raise HTTPException(status_code=400, detail="Missing issue key")
+    if event.changelog is not None:
+        changed_fields = {item.get("field") for item in event.changelog.get("items", [])}
+        if "description" not in changed_fields:
+            return {"issue_key": issue_key, "status": "ignored", "reason": "Description not changed"}
+
+    description = event.issue.get("fields", {}).get("description") or ""
+    status = schedule_issue_update(issue_key, description)
+    response = {"issue_key": issue_key, "status": status}
+    untracked = unattributed_case_ids(issue_key)
+    if status == "scheduled" and untracked:
+        response["note"] = (
+            f"Cases {untracked} from the full generation are not mapped to criteria and will not be updated; "
+            "changed criteria produce additional cases"
+        )
+    return response
+
 @app.post("/confluence/add-event/")
-async def confluence_add_event(event: ConfluenceEventInput):
+def confluence_add_event(event: ConfluenceEventInput):
     """
     Add an event to a Confluence Team Calendar.
     """
@@ -134,16 +173,29 @@ async def confluence_add_event(event: ConfluenceEventInput):
         
     return {"calendar_id": event.calendar_id, "event_added": True, "confluence_response": result}
 
+@app.post("/confluence/calendar/sync/")
+def confluence_sync_calendar(input_data: ConfluenceCalendarSyncInput):
+    """
+    Sync a batch of events to a Confluence Team Calendar: create, update or
+    delete only what differs from the events already in the subcalendar.
+    """
+    mismatched = [event.title for event in input_data.events if event.calendar_id != input_data.calendar_id]
+    if mismatched:
+        raise HTTPException(status_code=400, detail=f"Events belong to another calendar: {mismatched}")
+    return sync_calendar_events(
+        input_data.calendar_id, input_data.events, input_data.delete_missing, input_data.dry_run
+    )
+
 @app.get("/confluence/calendars/")
-async def get_confluence_calendars():
+def get_confluence_calendars(refresh: bool = False):
     """
     List available Confluence Team Calendars for the authenticated user.
     """
-    calendars = list_confluence_calendars()
+    calendars = list_confluence_calendars(refresh=refresh)
     return {"calendars": calendars}
 
 @app.get("/health")
-async def health_check():
+def health_check():
     """
     Health check endpoint.
     Checks FastAPI app status and optionally verifies connectivity to external services.
@@ -177,12 +229,17 @@ async def health_check():
         health["ollama"] = "ok" if ollama_status else "unreachable"
     except Exception:
         health["ollama"] = "unreachable"
+    ollama_queue = scheduler.metrics()
+    if health["ollama"] == "ok" and ollama_queue["queue_depth"] >= ollama_queue["max_queue"]:
+        health["ollama"] = "busy"
+    health["ollama_queue"] = ollama_queue
+    health["circuit_breakers"] = breaker_states()
 
 
     return health
 
 @app.get("/confluence/page/{page_id}")
-async def confluence_get_page(page_id: str):
+def confluence_get_page(page_id: str):
     """
     Get a Confluence page by its ID.
     """
@@ -190,7 +247,7 @@ async def confluence_get_page(page_id: str):
     return {"page": page}
 
 @app.post("/confluence/page/comment/")
-async def confluence_add_page_comment(input_data: ConfluencePageCommentInput):
+def confluence_add_page_comment(input_data: ConfluencePageCommentInput):
     """
     Add a comment to a Confluence page.
     """
@@ -199,7 +256,7 @@ async def confluence_add_page_comment(input_data: ConfluencePageCommentInput):
     return {"page_id": input_data.page_id, "comment_added": True, "confluence_response": result}
 
 @app.get("/confluence/page/{page_id}/comments")
-async def confluence_get_page_comments(page_id: str):
+def confluence_get_page_comments(page_id: str):
     """
     Get all comments for a Confluence page.
     """
@@ -216,7 +273,7 @@ async def confluence_get_page_comments(page_id: str):
 
 
 @app.get("/confluence/footer/{page_id}/comments")
-async def confluence_get_page_comments(page_id: str):
+def confluence_get_page_comments(page_id: str):
     """
     Get all comments for a Confluence page.
     """
@@ -237,22 +294,72 @@ class PromptRequest(BaseModel):
 @app.post("/chat")
 def chat(req: PromptRequest):
 
-    response = ollama_generate_prompt(req.prompt, req.model)
+    response = ollama_generate_prompt(req.prompt, req.model, priority=PRIORITY_INTERACTIVE)
     
     return response
 
+@app.get("/ollama/queue")
+def ollama_queue_metrics():
+    """
+    Queue depth and admission metrics of the Ollama scheduler.
+    """
+    return scheduler.metrics()
+
 class PromptTestRequest(BaseModel):
     prompt: str
     issue_key: str = "ITG-224"  # Default model
+    output_format: str = DEFAULT_OUTPUT_FORMAT  # "", "json" or "schema"
 @app.post("/prompt")
 def prompt(req:PromptTestRequest):
 
     user_story = fetch_issue_from_jira(req.issue_key)
 
-    response = generate_test_cases_ollama_prompt_test(user_story, req.prompt)
+    response = generate_test_cases_ollama_prompt_test(user_story, req.prompt, output_format=req.output_format)
     
     return response
 
+class PromptExperimentRequest(BaseModel):
+    prompts: List[str]
+    issue_keys: List[str] = []
+    corpus_path: Optional[str] = None  # JSONL corpus of stories, relative to PROMPT_EXPERIMENT_CORPUS_DIR
+    repeats: int = Field(1, ge=1)
+    max_workers: int = Field(4, ge=1)
+    output_format: str = DEFAULT_OUTPUT_FORMAT
+
+@app.post("/prompt/experiments")
+def prompt_experiment_start(req: PromptExperimentRequest):
+    """
+    Start a batch prompt experiment: every prompt variant against every story, run concurrently.
+    """
+    try:
+        experiment_id = start_experiment(
+            req.prompts, req.issue_keys, req.corpus_path, req.repeats, req.max_workers, req.output_format
+        )
+    except (ValueError, OSError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"experiment_id": experiment_id, "status": "running"}
+
+@app.post("/prompt/experiments/{experiment_id}/replay")
+def prompt_experiment_replay(experiment_id: str):
+    """
+    Re-run an earlier experiment with the same prompts and stories.
+    """
+    try:
+        new_id = replay_experiment(experiment_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Experiment {experiment_id} not found")
+    return {"experiment_id": new_id, "replay_of": experiment_id, "status": "running"}
+
+@app.get("/prompt/experiments/{experiment_id}")
+def prompt_experiment_results(experiment_id: str):
+    """
+    Per-prompt latency, token, parse success and case count summary of an experiment.
+    """
+    experiment = get_experiment(experiment_id)
+    if experiment is None:
+        raise HTTPException(status_code=404, detail=f"Experiment {experiment_id} not found")
+    return experiment
+
 class TestRailCaseInput(BaseModel):
     project_id: int
     suite_id: int
@@ -263,7 +370,7 @@ class TestRailCaseInput(BaseModel):
     automation_type: int = 0
 
 @app.post("/testrail/add-case/")
-async def testrail_add_case(input_data: TestRailCaseInput):
+def testrail_add_case(input_data: TestRailCaseInput):
     """
     Add a test case to TestRail.
     """
@@ -291,7 +398,7 @@ async def testrail_add_case(input_data: TestRailCaseInput):
 
 
 @app.get("/testrail/get-case/{case_id}")
-async def testrail_get_case(case_id: int):
+def testrail_get_case(case_id: int):
     """
     Get a test case from TestRail by its ID.
     """
@@ -300,3 +407,33 @@ async def testrail_get_case(case_id: int):
         return {"case_id": case_id, "case_details": response}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get test case: {str(e)}")
+
+@app.post("/testrail/results/")
+async def testrail_add_results(request: Request,
+                               project_id: int = DEFAULT_PROJECT_ID,
+                               suite_id: int = DEFAULT_SUITE_ID,
+                               run_id: Optional[int] = None,
+                               run_name: Optional[str] = None):
+    """
+    Report JUnit XML or JSON (pytest-json-report, list or NDJSON) test results to TestRail.
+
+    Tests are mapped to case ids ("C123" in the test name or a testrail_case_id
+    property). Without run_id a new run with the reported cases is created.
+    Results are pushed in chunked add_results_for_cases calls.
+    """
+    data = await request.body()
+    try:
+        results, unmapped = collect_results(data, request.headers.get("content-type", ""))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to parse test results: {str(e)}")
+    if not results:
+        raise HTTPException(status_code=400, detail=f"No results mapped to TestRail cases ({unmapped} unmapped)")
+
+    if run_id is None:
+        name = run_name or f"Automated run {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+        run = await run_in_threadpool(
+            create_test_run, project_id, suite_id, name, [result["case_id"] for result in results]
+        )
+        run_id = run["id"]
+    report = await run_in_threadpool(add_test_results, run_id, results)
+    return {**report, "results": len(results), "unmapped": unmapped}
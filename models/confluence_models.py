@@ -1,4 +1,5 @@
 from pydantic import BaseModel
+from typing import List
 
 class ConfluenceEventInput(BaseModel):
     calendar_id: str
@@ -9,4 +10,10 @@ class ConfluenceEventInput(BaseModel):
 
 class ConfluencePageCommentInput(BaseModel):
     page_id: str
-    comment: str
\ No newline at end of file
+    comment: str
+
+class ConfluenceCalendarSyncInput(BaseModel):
+    calendar_id: str
+    events: List[ConfluenceEventInput]
+    delete_missing: bool = False  # delete existing events in the batch's time window that are not in the batch
+    dry_run: bool = False
@@ -1,8 +1,14 @@
 from pydantic import BaseModel
+from typing import Optional
 
 class IssueKeyInput(BaseModel):
     issue_key: str
 
 class JiraCommentInput(BaseModel):
     issue_key: str
-    comment: str
\ No newline at end of file
+    comment: str
+
+class JiraWebhookEvent(BaseModel):
+    webhookEvent: str
+    issue: dict
+    changelog: Optional[dict] = None
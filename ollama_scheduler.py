@@ -0,0 +1,188 @@
+import os
+import heapq
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+from fastapi import HTTPException
+from state_backend import backend, WORKER_ID
+
+logging.basicConfig(level=logging.INFO, filename="log.log")
+logger = logging.getLogger(__name__)
+
+# Lower value is served first. /health does not queue; it only lists the models.
+PRIORITY_INTERACTIVE = 0  # /chat, /prompt
+PRIORITY_BATCH = 1        # /generate-test-cases/ and other bulk generation
+
+# Upper bound for one generation; a crashed worker's slot lease expires after this
+SLOT_LEASE_TTL = float(os.getenv("OLLAMA_SLOT_LEASE_TTL", "300"))
+SLOT_POLL_INTERVAL = 0.2
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_BATCH: "batch",
+}
+
+
+class OllamaScheduler:
+    """
+    Admission control in front of the Ollama API.
+
+    At most `max_concurrency` generations run at once. Further callers wait in a
+    bounded priority queue; when the queue is full, the newest waiter of a lower
+    priority makes room for the caller, otherwise the caller is rejected right
+    away with 429. Callers that wait longer than `queue_timeout` get 503.
+
+    The queue is per process. With several workers, an admitted caller also
+    takes one of `total_concurrency` slot leases in the shared state backend,
+    so the workers together never run more than that many generations.
+    """
+
+    def __init__(self, max_concurrency: int = 1, max_queue: int = 16, queue_timeout: float = 30.0,
+                 total_concurrency: Optional[int] = None):
+        self.max_concurrency = max_concurrency
+        self.total_concurrency = total_concurrency or max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._waiting = []  # heap of (priority, seq)
+        self._evicted = set()  # entries pushed out of a full queue by a higher priority
+        self._seq = itertools.count()
+        self._active = 0
+        self._stats = {name: {"admitted": 0, "rejected": 0, "timed_out": 0} for name in PRIORITY_NAMES.values()}
+        self._total_wait = 0.0
+
+    def _reject(self, status_code: int, detail: str, priority: int):
+        name = PRIORITY_NAMES.get(priority, str(priority))
+        logger.warning(f"Ollama request rejected ({name}): {detail}")
+        raise HTTPException(
+            status_code=status_code,
+            detail=detail,
+            headers={"Retry-After": str(max(1, int(self.queue_timeout)))}
+        )
+
+    def acquire(self, priority: int = PRIORITY_BATCH) -> str:
+        """
+        Wait for a free generation slot, or raise HTTPException(429/503).
+
+        Returns the shared slot lease to pass to release().
+        """
+        name = PRIORITY_NAMES.get(priority, str(priority))
+        started = time.monotonic()
+        deadline = started + self.queue_timeout
+        self._acquire_local(priority, deadline)
+        try:
+            lease = self._acquire_lease(deadline)
+        except Exception:
+            # e.g. a locked SQLite file or an unreachable Redis; don't leak the local slot
+            self.release()
+            raise
+        if lease is None:
+            self.release()
+            with self._cond:
+                self._stats[name]["timed_out"] += 1
+            self._reject(503, "Timed out waiting for an Ollama slot", priority)
+        with self._cond:
+            self._stats[name]["admitted"] += 1
+            self._total_wait += time.monotonic() - started
+        return lease
+
+    def _acquire_local(self, priority: int, deadline: float):
+        name = PRIORITY_NAMES.get(priority, str(priority))
+        with self._cond:
+            if self._active < self.max_concurrency and not self._waiting:
+                self._active += 1
+                return
+            if len(self._waiting) >= self.max_queue:
+                victim = max(self._waiting) if self._waiting else None
+                if victim is None or victim[0] <= priority:
+                    self._stats[name]["rejected"] += 1
+                    self._reject(429, "Ollama queue is full, try again later", priority)
+                self._waiting.remove(victim)
+                heapq.heapify(self._waiting)
+                self._evicted.add(victim)
+
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiting, entry)
+            self._cond.notify_all()
+            while not (self._waiting[0] == entry and self._active < self.max_concurrency):
+                if entry in self._evicted:
+                    self._evicted.discard(entry)
+                    self._stats[name]["rejected"] += 1
+                    self._reject(429, "Ollama queue is full, try again later", priority)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    self._stats[name]["timed_out"] += 1
+                    # Whoever is now at the head may be able to run
+                    self._cond.notify_all()
+                    self._reject(503, "Timed out waiting for an Ollama slot", priority)
+                self._cond.wait(remaining)
+
+            heapq.heappop(self._waiting)
+            self._active += 1
+            self._cond.notify_all()
+
+    def _acquire_lease(self, deadline: float) -> Optional[str]:
+        """
+        Take one of the shared slot leases, polling until `deadline`; None if all stay taken.
+        """
+        while True:
+            for index in range(self.total_concurrency):
+                lease = f"ollama:slot:{index}"
+                if backend.add(lease, WORKER_ID, ttl=SLOT_LEASE_TTL):
+                    return lease
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(SLOT_POLL_INTERVAL)
+
+    def release(self, lease: Optional[str] = None):
+        if lease:
+            backend.delete(lease)
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, priority: int = PRIORITY_BATCH):
+        lease = self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(lease)
+
+    def metrics(self) -> dict:
+        """
+        Snapshot of queue depth and admission counters.
+        """
+        # Leases held by all workers together
+        shared_active = len(backend.keys("ollama:slot:"))
+        with self._cond:
+            depth = {name: 0 for name in PRIORITY_NAMES.values()}
+            for priority, _ in self._waiting:
+                name = PRIORITY_NAMES.get(priority, str(priority))
+                depth[name] = depth.get(name, 0) + 1
+            admitted = sum(s["admitted"] for s in self._stats.values())
+            return {
+                "active": self._active,
+                "max_concurrency": self.max_concurrency,
+                "shared_active": shared_active,
+                "total_concurrency": self.total_concurrency,
+                "queue_depth": len(self._waiting),
+                "max_queue": self.max_queue,
+                "queue_depth_by_priority": depth,
+                "stats": {name: dict(s) for name, s in self._stats.items()},
+                "avg_wait_seconds": round(self._total_wait / admitted, 3) if admitted else 0.0,
+            }
+
+
+scheduler = OllamaScheduler(
+    max_concurrency=int(os.getenv("OLLAMA_MAX_CONCURRENCY", "1")),
+    max_queue=int(os.getenv("OLLAMA_MAX_QUEUE", "16")),
+    queue_timeout=float(os.getenv("OLLAMA_QUEUE_TIMEOUT", "30")),
+    # Across all workers; defaults to OLLAMA_MAX_CONCURRENCY
+    total_concurrency=int(os.getenv("OLLAMA_TOTAL_CONCURRENCY", "0")) or None,
+)
@@ -0,0 +1,240 @@
+import os
+import json
+import uuid
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from jira_service import fetch_issue_from_jira
+from ollama_service import run_prompt_test_ollama, DEFAULT_OUTPUT_FORMAT
+from ollama_scheduler import scheduler, PRIORITY_BATCH
+from state_backend import backend, cached_call
+
+logging.basicConfig(level=logging.INFO, filename="log.log")
+logger = logging.getLogger(__name__)
+
+# Local JSONL results store: one "experiment" record per run of the runner, one "run" record per prompt/story/repeat
+RESULTS_PATH = os.getenv("PROMPT_EXPERIMENT_RESULTS", "prompt_experiments.jsonl")
+# Seconds a fetched story is reused by experiments
+STORY_CACHE_TTL = float(os.getenv("PROMPT_EXPERIMENT_STORY_TTL", "3600"))
+# Corpus files can only be read from inside this directory
+CORPUS_DIR = os.getenv("PROMPT_EXPERIMENT_CORPUS_DIR", "corpus")
+
+_results_lock = threading.Lock()
+
+
+def _set_status(experiment_id: str, status: str):
+    # "running" | "finished" | "failed", visible to every worker
+    backend.set(f"experiment:status:{experiment_id}", status)
+
+
+def fetch_story_cached(issue_key: str) -> str:
+    """
+    Fetch a user story from JIRA once; experiments reuse the same stories many times.
+    """
+    return cached_call(f"jira:story:{issue_key}", lambda: fetch_issue_from_jira(issue_key), ttl=STORY_CACHE_TTL)
+
+
+def resolve_corpus_path(path: str) -> str:
+    """
+    Resolve a corpus path relative to CORPUS_DIR, refusing paths that leave it.
+    """
+    corpus_dir = os.path.realpath(CORPUS_DIR)
+    resolved = os.path.realpath(os.path.join(corpus_dir, path))
+    if os.path.commonpath([corpus_dir, resolved]) != corpus_dir:
+        raise ValueError(f"Corpus path must be inside {CORPUS_DIR}: {path}")
+    return resolved
+
+
+def load_corpus(path: str) -> List[dict]:
+    """
+    Load stories from a local JSONL corpus in CORPUS_DIR.
+
+    Each line needs an id (`issue_key`, `request_id` or `id`) and a story
+    (`description`, `user_story` or `body`); an optional `title` is prepended.
+    """
+    stories = []
+    with open(resolve_corpus_path(path), encoding="utf-8") as corpus:
+        for line_no, line in enumerate(corpus, start=1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            story_id = item.get("issue_key") or item.get("request_id") or item.get("id") or f"line-{line_no}"
+            story = item.get("description") or item.get("user_story") or item.get("body") or ""
+            if item.get("title"):
+                story = f"{item['title']}\n\n{story}"
+            stories.append({"id": str(story_id), "story": story})
+    return stories
+
+
+def _append_record(record: dict):
+    with _results_lock:
+        with open(RESULTS_PATH, "a", encoding="utf-8") as results:
+            results.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def read_records(experiment_id: str) -> List[dict]:
+    if not os.path.exists(RESULTS_PATH):
+        return []
+    with _results_lock:
+        with open(RESULTS_PATH, encoding="utf-8") as results:
+            records = [json.loads(line) for line in results if line.strip()]
+    return [record for record in records if record.get("experiment_id") == experiment_id]
+
+
+def _run_one(experiment_id: str, prompt_index: int, prompt: str, story: dict, repeat: int, output_format: str) -> dict:
+    record = {
+        "kind": "run",
+        "experiment_id": experiment_id,
+        "prompt_index": prompt_index,
+        "prompt_hash": hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12],
+        "story_id": story["id"],
+        "repeat": repeat,
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    try:
+        user_story = story["story"] if story.get("story") is not None else fetch_story_cached(story["id"])
+        # Lets a replay tell whether the story changed since the original run
+        record["story_hash"] = hashlib.sha256(user_story.encode("utf-8")).hexdigest()[:12]
+        cases, response = run_prompt_test_ollama(user_story, prompt, priority=PRIORITY_BATCH, output_format=output_format)
+        # Ollama's own timings (nanoseconds) exclude the time spent in the scheduler queue
+        record.update({
+            "latency_seconds": round(response["total_duration"] / 1e9, 3) if response.get("total_duration") else None,
+            "prompt_tokens": response.get("prompt_eval_count"),
+            "completion_tokens": response.get("eval_count"),
+            "tokens_per_second": round(response["eval_count"] / (response["eval_duration"] / 1e9), 2)
+            if response.get("eval_count") and response.get("eval_duration") else None,
+            "parse_ok": bool(cases),
+            "case_count": len(cases),
+            "error": None,
+        })
+    except Exception as e:
+        logger.error(f"Prompt experiment run failed ({story['id']}, prompt {prompt_index}): {str(e)}")
+        record.update({
+            "latency_seconds": None,
+            "parse_ok": False,
+            "case_count": 0,
+            "error": str(e),
+        })
+    _append_record(record)
+    return record
+
+
+def summarize(records: List[dict]) -> List[dict]:
+    """
+    Aggregate run records per prompt variant.
+    """
+    by_prompt = {}
+    for record in records:
+        if record.get("kind") == "run":
+            by_prompt.setdefault(record["prompt_index"], []).append(record)
+
+    summary = []
+    for prompt_index, runs in sorted(by_prompt.items()):
+        ok_runs = [run for run in runs if not run.get("error")]
+        latencies = sorted(run["latency_seconds"] for run in ok_runs if run.get("latency_seconds") is not None)
+        completion_tokens = [run["completion_tokens"] for run in ok_runs if run.get("completion_tokens") is not None]
+        summary.append({
+            "prompt_index": prompt_index,
+            "prompt_hash": runs[0]["prompt_hash"],
+            "runs": len(runs),
+            "errors": len(runs) - len(ok_runs),
+            "parse_success_rate": round(sum(run["parse_ok"] for run in runs) / len(runs), 3),
+            "avg_case_count": round(sum(run["case_count"] for run in runs) / len(runs), 2),
+            "avg_latency_seconds": round(sum(latencies) / len(latencies), 3) if latencies else None,
+            "p95_latency_seconds": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None,
+            "avg_completion_tokens": round(sum(completion_tokens) / len(completion_tokens), 1) if completion_tokens else None,
+        })
+    return summary
+
+
+def _run_experiment(experiment_id: str, prompts: List[str], stories: List[dict], repeats: int,
+                    max_workers: int, output_format: str):
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [
+                pool.submit(_run_one, experiment_id, prompt_index, prompt, story, repeat, output_format)
+                for repeat in range(repeats)
+                for prompt_index, prompt in enumerate(prompts)
+                for story in stories
+            ]
+            for future in futures:
+                future.result()
+        _set_status(experiment_id, "finished")
+    except Exception as e:
+        logger.error(f"Prompt experiment {experiment_id} failed: {str(e)}")
+        _set_status(experiment_id, "failed")
+
+
+def start_experiment(prompts: List[str], issue_keys: Optional[List[str]] = None, corpus_path: Optional[str] = None,
+                     repeats: int = 1, max_workers: int = 4, output_format: str = DEFAULT_OUTPUT_FORMAT) -> str:
+    """
+    Start a prompt experiment in the background and return its id.
+
+    Every prompt variant is run against every story `repeats` times. Stories
+    come from JIRA issue keys (fetched once) and/or a local JSONL corpus.
+    max_workers is capped at the scheduler's concurrency.
+    """
+    if repeats < 1 or max_workers < 1:
+        raise ValueError("repeats and max_workers must be at least 1")
+    # More workers than Ollama slots would only queue in the scheduler and time out
+    max_workers = min(max_workers, scheduler.max_concurrency)
+    stories = [{"id": key, "story": None} for key in issue_keys or []]
+    if corpus_path:
+        stories.extend(load_corpus(corpus_path))
+    if not prompts or not stories:
+        raise ValueError("An experiment needs at least one prompt and one story")
+
+    experiment_id = uuid.uuid4().hex[:12]
+    _append_record({
+        "kind": "experiment",
+        "experiment_id": experiment_id,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "prompts": prompts,
+        "issue_keys": issue_keys or [],
+        "corpus_path": corpus_path,
+        "repeats": repeats,
+        "max_workers": max_workers,
+        "output_format": output_format,
+        "total_runs": len(prompts) * len(stories) * repeats,
+    })
+    _set_status(experiment_id, "running")
+    thread = threading.Thread(
+        target=_run_experiment,
+        args=(experiment_id, prompts, stories, repeats, max_workers, output_format),
+        daemon=True
+    )
+    thread.start()
+    logger.info(f"Started prompt experiment {experiment_id}: {len(prompts)} prompts x {len(stories)} stories x {repeats}")
+    return experiment_id
+
+
+def replay_experiment(experiment_id: str) -> str:
+    """
+    Start a new experiment with the same configuration as an earlier one.
+    """
+    config = next((record for record in read_records(experiment_id) if record["kind"] == "experiment"), None)
+    if config is None:
+        raise KeyError(experiment_id)
+    return start_experiment(
+        config["prompts"], config["issue_keys"], config["corpus_path"],
+        config["repeats"], config["max_workers"], config["output_format"]
+    )
+
+
+def get_experiment(experiment_id: str) -> Optional[dict]:
+    records = read_records(experiment_id)
+    config = next((record for record in records if record["kind"] == "experiment"), None)
+    if config is None:
+        return None
+    runs = [record for record in records if record["kind"] == "run"]
+    return {
+        "experiment_id": experiment_id,
+        "status": backend.get(f"experiment:status:{experiment_id}") or "unknown",
+        "completed_runs": len(runs),
+        "config": config,
+        "summary": summarize(runs),
+    }
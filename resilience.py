@@ -0,0 +1,243 @@
+import os
+import time
+import random
+import logging
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+from typing import Callable, Optional
+
+import requests
+from fastapi import HTTPException
+
+logging.basicConfig(level=logging.INFO, filename="log.log")
+logger = logging.getLogger(__name__)
+
+RETRY_ATTEMPTS = int(os.getenv("UPSTREAM_RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("UPSTREAM_RETRY_MAX_DELAY", "8"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("UPSTREAM_BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("UPSTREAM_BREAKER_RESET_SECONDS", "30"))
+# Seconds to wait for a GET before sending a second, hedged copy; 0 disables hedging
+HEDGE_DELAY = float(os.getenv("UPSTREAM_HEDGE_DELAY", "1.5"))
+REQUEST_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "30"))
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+# Concurrent hedge copies; further slow requests are not hedged
+HEDGE_POOL_SIZE = int(os.getenv("UPSTREAM_HEDGE_POOL_SIZE", "8"))
+
+_hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_POOL_SIZE, thread_name_prefix="hedge")
+_hedge_slots = threading.Semaphore(HEDGE_POOL_SIZE)
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker.
+
+    Opens after `failure_threshold` consecutive failures; while open, calls
+    fail fast. After `reset_timeout` one trial call is let through (half-open)
+    and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, host: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_SECONDS):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_running:
+                raise HTTPException(status_code=503, detail=f"Circuit open for {self.host}, upstream is failing")
+            self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def release_trial(self):
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning(f"Circuit opened for {self.host} after {self._failures} failures")
+                self._opened_at = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(url_or_host: str) -> CircuitBreaker:
+    host = urlparse(url_or_host).netloc or url_or_host
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
+
+
+def breaker_states() -> dict:
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.host: breaker.state for breaker in breakers}
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    Exponential backoff with full jitter for the given (1-based) attempt.
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+def _run_in_thread(send: Callable[[], requests.Response]) -> Future:
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(send())
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True, name="hedge-primary").start()
+    return future
+
+
+def _hedged(send: Callable[[], requests.Response], delay: float) -> requests.Response:
+    """
+    Send a request and, if it has not completed after `delay` seconds, a
+    second identical one; the first successful answer wins.
+
+    The primary gets its own thread, so it never queues behind other
+    requests. Only hedge copies use the shared pool, and none is sent
+    while the pool is busy.
+    """
+    futures = [_run_in_thread(send)]
+    done, _ = wait(futures, timeout=delay)
+    if not done and _hedge_slots.acquire(blocking=False):
+        hedge = _hedge_pool.submit(send)
+        hedge.add_done_callback(lambda _: _hedge_slots.release())
+        futures.append(hedge)
+    error = None
+    for future in as_completed(futures):
+        try:
+            # The slower copy, if any, is left to finish on its own
+            return future.result()
+        except Exception as e:
+            error = e
+    raise error
+
+
+def resilient_request(method: str, url: str, hedge: bool = False, attempts: int = RETRY_ATTEMPTS,
+                      session: Optional[requests.Session] = None, **kwargs) -> requests.Response:
+    """
+    requests.request with retries, a per-host circuit breaker and optional hedging.
+
+    Idempotent methods are retried on connection errors, timeouts and
+    429/5xx responses; other methods only when the request was not accepted
+    (connection refused, 429). The last response is returned as is, so
+    callers keep handling non-2xx answers themselves. Pass a `session` to
+    reuse pooled connections.
+    """
+    method = method.upper()
+    idempotent = method in IDEMPOTENT_METHODS
+    kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+    breaker = breaker_for(url)
+
+    def send():
+        return (session or requests).request(method, url, **kwargs)
+
+    for attempt in range(1, attempts + 1):
+        breaker.before_call()
+        try:
+            if hedge and idempotent and HEDGE_DELAY > 0:
+                response = _hedged(send, HEDGE_DELAY)
+            else:
+                response = send()
+        except requests.RequestException as e:
+            # Any failed send (including e.g. ChunkedEncodingError) ends a half-open trial
+            breaker.record_failure()
+            transient = isinstance(e, (requests.ConnectionError, requests.Timeout))
+            not_sent = isinstance(e, requests.ConnectionError) and not isinstance(e, requests.ReadTimeout)
+            if attempt == attempts or not transient or not (idempotent or not_sent):
+                raise
+            logger.warning(f"{method} {url} failed (attempt {attempt}): {str(e)}")
+            time.sleep(backoff_delay(attempt))
+            continue
+        except BaseException:
+            # Not the upstream's fault; just let the next call be the trial
+            breaker.release_trial()
+            raise
+
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        retryable = response.status_code == 429 or (idempotent and response.status_code in RETRYABLE_STATUS_CODES)
+        if not retryable or attempt == attempts:
+            return response
+        logger.warning(f"{method} {url} returned {response.status_code} (attempt {attempt})")
+        retry_after = response.headers.get("Retry-After", "")
+        time.sleep(min(float(retry_after), RETRY_MAX_DELAY) if retry_after.isdigit() else backoff_delay(attempt))
+    return response
+
+
+def _status_code_of(error: Exception) -> Optional[int]:
+    status = getattr(error, "status_code", None)
+    if status is None and error.args and isinstance(error.args[0], int):
+        status = error.args[0]
+    return status
+
+
+def call_with_retry(host: str, fn: Callable, *args, idempotent: bool = True, attempts: int = RETRY_ATTEMPTS, **kwargs):
+    """
+    Call an SDK function (e.g. the TestRail client) with retries and the host's circuit breaker.
+
+    Client errors (4xx other than 429) are raised right away. Non-idempotent
+    calls are only retried when the connection could not be established.
+    """
+    breaker = breaker_for(host)
+    for attempt in range(1, attempts + 1):
+        breaker.before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            if not isinstance(e, Exception):
+                breaker.release_trial()
+                raise
+            status = _status_code_of(e)
+            if status is not None and 400 <= status < 500 and status != 429:
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            not_sent = isinstance(e, requests.ConnectionError) and not isinstance(e, requests.ReadTimeout)
+            if attempt == attempts or not (idempotent or not_sent or status == 429):
+                raise
+            logger.warning(f"Call to {host} failed (attempt {attempt}): {str(e)}")
+            time.sleep(backoff_delay(attempt))
+            continue
+        breaker.record_success()
+        return result
@@ -0,0 +1,40 @@
+"""
+Multi-worker entry point.
+
+    python serve.py --workers 4 --port 8000
+
+Runs main:app in several uvicorn worker processes on one machine. All
+workers share generation caches, in-flight deduplication and job state
+(Jira webhook state, prompt experiment status) through STATE_BACKEND:
+
+    STATE_BACKEND=sqlite:///state.db      SQLite in WAL mode (default here with more than one worker)
+    STATE_BACKEND=redis://localhost:6379/0 Redis or a compatible server (needs the redis package)
+    STATE_BACKEND=memory                  per process, only for a single worker
+
+OLLAMA_MAX_CONCURRENCY and OLLAMA_MAX_QUEUE bound each worker's own queue.
+OLLAMA_TOTAL_CONCURRENCY (default: OLLAMA_MAX_CONCURRENCY) caps the
+generations all workers run together, through slot leases in STATE_BACKEND.
+Adding workers therefore adds request handlers, not Ollama load.
+"""
+import os
+import argparse
+import uvicorn
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the API with several uvicorn workers")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "2")))
+    args = parser.parse_args()
+
+    if args.workers > 1 and os.getenv("STATE_BACKEND", "memory") == "memory":
+        # Workers inherit the environment, so they all open the same file
+        os.environ["STATE_BACKEND"] = "sqlite:///state.db"
+        print("STATE_BACKEND is not shared between workers, using sqlite:///state.db")
+
+    uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Callable, List, Optional
+
+logging.basicConfig(level=logging.INFO, filename="log.log")
+logger = logging.getLogger(__name__)
+
+# "memory" (per process), "sqlite:///path/to/state.db" or "redis://host:port/db"
+STATE_BACKEND_URL = os.getenv("STATE_BACKEND", "memory")
+
+# Identifies this process as the owner of in-flight locks
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+class StateBackend(ABC):
+    """
+    Minimal key-value store shared by all workers: JSON values with optional TTL.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        ...
+
+    @abstractmethod
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        """
+        Set the key only if it does not exist yet; returns True if it was set.
+        """
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    def keys(self, prefix: str = "") -> List[str]:
+        ...
+
+
+class MemoryBackend(StateBackend):
+    """
+    Process-local backend; the default for a single uvicorn worker.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}  # key -> (json value, expires_at or None)
+
+    def _alive(self, key: str):
+        item = self._data.get(key)
+        if item is not None and item[1] is not None and item[1] < time.time():
+            del self._data[key]
+            return None
+        return item
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._alive(key)
+        return json.loads(item[0]) if item else None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        with self._lock:
+            self._data[key] = (json.dumps(value), time.time() + ttl if ttl else None)
+
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        with self._lock:
+            if self._alive(key):
+                return False
+            self._data[key] = (json.dumps(value), time.time() + ttl if ttl else None)
+            return True
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def keys(self, prefix: str = "") -> List[str]:
+        with self._lock:
+            return [key for key in list(self._data) if key.startswith(prefix) and self._alive(key)]
+
+
+class SQLiteBackend(StateBackend):
+    """
+    SQLite file in WAL mode, shared by all workers on one machine.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit; one connection per thread
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _purge_expired(self, conn: sqlite3.Connection):
+        self._writes += 1
+        if self._writes % 100 == 0:
+            conn.execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),))
+
+    def get(self, key: str) -> Optional[Any]:
+        row = self._conn().execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at >= ?)",
+            (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), time.time() + ttl if ttl else None)
+        )
+        self._purge_expired(conn)
+
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM kv WHERE key = ? AND expires_at IS NOT NULL AND expires_at < ?", (key, now))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), now + ttl if ttl else None)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return cursor.rowcount == 1
+
+    def delete(self, key: str):
+        self._conn().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def keys(self, prefix: str = "") -> List[str]:
+        rows = self._conn().execute(
+            "SELECT key FROM kv WHERE key LIKE ? ESCAPE '\\' AND (expires_at IS NULL OR expires_at >= ?)",
+            (prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%", time.time())
+        ).fetchall()
+        return [row[0] for row in rows]
+
+
+class RedisBackend(StateBackend):
+    """
+    Redis (or a Redis-compatible server) backend; needs the optional `redis` package.
+    """
+
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND is a redis:// URL but the redis package is not installed")
+        self._client = redis.Redis.from_url(url)
+
+    @staticmethod
+    def _ttl(ttl: Optional[float]) -> Optional[int]:
+        return max(1, int(ttl)) if ttl else None
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self._client.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        self._client.set(key, json.dumps(value), ex=self._ttl(ttl))
+
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        return bool(self._client.set(key, json.dumps(value), ex=self._ttl(ttl), nx=True))
+
+    def delete(self, key: str):
+        self._client.delete(key)
+
+    def keys(self, prefix: str = "") -> List[str]:
+        return [key.decode("utf-8") for key in self._client.scan_iter(match=f"{prefix}*")]
+
+
+def create_backend(url: str = STATE_BACKEND_URL) -> StateBackend:
+    if url == "memory":
+        return MemoryBackend()
+    if url.startswith("sqlite:"):
+        # sqlite:///relative.db, sqlite:////absolute/path.db
+        path = url[len("sqlite:///"):] if url.startswith("sqlite:///") else url[len("sqlite:"):]
+        return SQLiteBackend(path or "state.db")
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url)
+    raise RuntimeError(f"Unsupported STATE_BACKEND: {url}")
+
+
+backend = create_backend()
+
+
+def cached_call(key: str, compute: Callable[[], Any], ttl: float, lock_ttl: float = 120,
+                wait_timeout: float = 180, poll_interval: float = 0.5) -> Any:
+    """
+    Return the cached value for `key`, computing it at most once across workers.
+
+    The first caller takes an in-flight lock and computes; concurrent callers
+    (in any worker) wait for its result instead of repeating the work. If the
+    owner fails or its lock expires, a waiter takes over.
+    """
+    value = backend.get(key)
+    if value is not None:
+        return value
+    lock_key = f"{key}:inflight"
+    deadline = time.monotonic() + wait_timeout
+    while True:
+        if backend.add(lock_key, WORKER_ID, ttl=lock_ttl):
+            try:
+                value = compute()
+                if ttl > 0:
+                    backend.set(key, value, ttl=ttl)
+                return value
+            finally:
+                backend.delete(lock_key)
+        time.sleep(poll_interval)
+        value = backend.get(key)
+        if value is not None:
+            return value
+        if time.monotonic() > deadline:
+            logger.warning(f"Gave up waiting for in-flight computation of {key}")
+            return compute()
@@ -0,0 +1,114 @@
+import pytest
+from fastapi import HTTPException
+
+import confluence_service
+from confluence_service import add_event_to_calendar, get_calendar_events, sync_calendar_events, _sync_window
+from models.confluence_models import ConfluenceEventInput
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self.ok = True
+        self.status_code = 200
+        self.text = ""
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+
+class FakeCalendar:
+    """
+    Stands in for the Team Calendars events.json endpoint; lists times as UTC with a Z suffix.
+    """
+
+    def __init__(self, monkeypatch, events):
+        self.events = {str(index): event for index, event in enumerate(events, start=1)}
+        self.requests = []
+        monkeypatch.setenv("CONFLUENCE_BASE_URL", "https://confluence.example.com")
+        monkeypatch.setenv("CONFLUENCE_API_TOKEN", "token")
+        monkeypatch.setattr(confluence_service, "resilient_request", self.request)
+
+    def request(self, method, url, params=None, json=None, **kwargs):
+        self.requests.append(method)
+        if method == "GET":
+            return FakeResponse({"events": [{"id": uid, **event} for uid, event in self.events.items()]})
+        if method == "POST":
+            uid = str(len(self.events) + 1)
+            self.events[uid] = {key: json[key] for key in ("title", "start", "end", "description")}
+            return FakeResponse({"id": uid})
+        if method == "PUT":
+            self.events[json["uid"]] = {key: json[key] for key in ("title", "start", "end", "description")}
+            return FakeResponse({"id": json["uid"]})
+        del self.events[params["uid"]]
+        return FakeResponse({})
+
+
+def event(title, start, end, description=""):
+    return ConfluenceEventInput(calendar_id="cal", title=title, start=start, end=end, description=description)
+
+
+LISTED = [
+    {"title": "Nightly run", "start": "2024-05-01T22:00:00Z", "end": "2024-05-01T23:00:00Z", "description": ""},
+    {"title": "Nightly run", "start": "2024-05-02T22:00:00Z", "end": "2024-05-02T23:00:00Z", "description": ""},
+    {"title": "Release", "start": "2024-05-03T10:00:00.000Z", "end": "2024-05-03T12:00:00.000Z", "description": "v2"},
+]
+
+
+def test_sync_window_compares_times_not_strings():
+    events = [
+        event("a", "2024-05-01T09:00:00+02:00", "2024-05-01T10:00:00+02:00"),
+        event("b", "2024-05-01T08:00:00Z", "2024-05-01T09:30"),
+        event("c", "2024-04-30", "2024-04-30T23:00:00.123"),
+    ]
+    assert _sync_window(events) == ("2024-04-30T00:00:00Z", "2024-05-01T09:30:00Z")
+
+
+def test_sync_window_rejects_invalid_times():
+    with pytest.raises(HTTPException) as error:
+        _sync_window([event("a", "tomorrow", "2024-05-01")])
+    assert error.value.status_code == 400
+
+
+def test_unchanged_naive_batch_matches_utc_listing(monkeypatch):
+    FakeCalendar(monkeypatch, LISTED)
+    batch = [
+        event("Nightly run", "2024-05-01T22:00:00", "2024-05-01T23:00:00"),
+        event("Nightly run", "2024-05-02T22:00:00", "2024-05-02T23:00:00"),
+        event("Release", "2024-05-03T12:00:00+02:00", "2024-05-03T14:00:00+02:00", "v2"),
+    ]
+
+    result = sync_calendar_events("cal", batch, delete_missing=True, dry_run=True)
+
+    assert (result["created"], result["updated"], result["deleted"], result["unchanged"]) == ([], [], [], 3)
+
+
+def test_sync_creates_updates_and_deletes(monkeypatch):
+    calendar = FakeCalendar(monkeypatch, LISTED)
+    batch = [
+        event("Nightly run", "2024-05-01T22:00:00", "2024-05-01T23:30:00"),
+        event("Release", "2024-05-03T10:00:00Z", "2024-05-03T12:00:00Z", "v2"),
+        event("Retro", "2024-05-03T15:00:00Z", "2024-05-03T16:00:00Z"),
+    ]
+
+    result = sync_calendar_events("cal", batch, delete_missing=True)
+
+    assert result["created"] == ["Retro"]
+    assert result["updated"] == ["Nightly run"]
+    assert result["deleted"] == ["Nightly run"]
+    assert result["unchanged"] == 1
+    assert calendar.events["1"]["end"] == "2024-05-01T23:30:00"
+    assert "2" not in calendar.events
+
+
+def test_adding_an_event_invalidates_cached_listings(monkeypatch):
+    calendar = FakeCalendar(monkeypatch, [])
+    window = ("2024-05-01T15:00:00Z", "2024-05-01T16:00:00Z")
+    assert get_calendar_events("cal", *window) == []
+    retro = event("Retro", *window)
+    add_event_to_calendar(retro)
+
+    assert [listed["title"] for listed in get_calendar_events("cal", *window)] == ["Retro"]
+    result = sync_calendar_events("cal", [retro])
+    assert result["created"] == [] and result["unchanged"] == 1
+    assert calendar.requests.count("POST") == 1
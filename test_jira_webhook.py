@@ -0,0 +1,112 @@
+import pytest
+
+import jira_webhook
+from jira_webhook import split_acceptance_criteria, process_issue_update
+from state_backend import backend
+
+STORY = """As a customer I want to log in.
+
+Acceptance Criteria:
+* valid credentials open the dashboard
+* wrong password shows an error
+  and keeps the username
+* locked accounts cannot log in
+"""
+
+
+class FakeTestRail:
+    """
+    Stands in for Ollama and TestRail: one case per criterion, ids from 101 on.
+    """
+
+    def __init__(self, monkeypatch):
+        self.next_id = 101
+        self.posted, self.updated = [], []
+        self.fail_on, self.empty_on = set(), set()
+        monkeypatch.setattr(jira_webhook, "generate_test_cases_ollama", self.generate)
+        monkeypatch.setattr(jira_webhook, "post_test_case_to_testrail", self.post)
+        monkeypatch.setattr(jira_webhook, "update_test_case_in_testrail", self.update)
+
+    def generate(self, description, priority, criterion):
+        if criterion in self.fail_on:
+            raise RuntimeError("Ollama is down")
+        if criterion in self.empty_on:
+            return []
+        return [{"title": criterion, "custom_steps": "step"}]
+
+    def post(self, payload):
+        self.posted.append(payload.title)
+        self.next_id += 1
+        return {"id": self.next_id - 1}
+
+    def update(self, case_id, payload):
+        self.updated.append((case_id, payload.title))
+
+
+@pytest.fixture
+def testrail(monkeypatch):
+    return FakeTestRail(monkeypatch)
+
+
+def tracked(issue_key):
+    return {c["text"]: c["case_ids"] for c in backend.get(f"jira:processed:{issue_key}")["criteria"]}
+
+
+def test_split_acceptance_criteria_uses_list_items_after_heading():
+    assert split_acceptance_criteria(STORY) == [
+        "valid credentials open the dashboard",
+        "wrong password shows an error and keeps the username",
+        "locked accounts cannot log in",
+    ]
+
+
+def test_split_acceptance_criteria_without_heading_or_description():
+    assert split_acceptance_criteria("1. first\n2) second") == ["first", "second"]
+    assert split_acceptance_criteria("") == []
+
+
+def test_first_update_creates_a_case_per_criterion(testrail):
+    summary = process_issue_update("QA-1", STORY)
+
+    assert summary == {"unchanged": 0, "added": 3, "changed": 0, "removed": 0}
+    assert len(testrail.posted) == 3
+    assert tracked("QA-1")["locked accounts cannot log in"] == [103]
+
+
+def test_changed_criterion_updates_its_case_in_place(testrail):
+    process_issue_update("QA-1", STORY)
+    edited = STORY.replace("locked accounts cannot log in", "locked accounts see a support link")
+
+    summary = process_issue_update("QA-1", edited)
+
+    assert summary == {"unchanged": 2, "added": 0, "changed": 1, "removed": 0}
+    assert testrail.posted == split_acceptance_criteria(STORY)
+    assert testrail.updated == [(103, "locked accounts see a support link")]
+
+
+def test_failed_criterion_keeps_progress_and_retry_does_not_duplicate(testrail):
+    testrail.fail_on.add("locked accounts cannot log in")
+    with pytest.raises(RuntimeError):
+        process_issue_update("QA-1", STORY)
+    assert len(testrail.posted) == 2
+
+    testrail.fail_on.clear()
+    process_issue_update("QA-1", STORY)
+
+    assert testrail.posted == split_acceptance_criteria(STORY)
+    assert backend.get("jira:processed:QA-1")["description"] == STORY
+
+
+def test_empty_generation_keeps_the_old_cases_tracked(testrail):
+    process_issue_update("QA-1", STORY)
+    edited = STORY.replace("locked accounts cannot log in", "locked accounts see a support link")
+    testrail.empty_on.add("locked accounts see a support link")
+
+    with pytest.raises(ValueError):
+        process_issue_update("QA-1", edited)
+    testrail.empty_on.clear()
+    process_issue_update("QA-1", edited)
+
+    assert testrail.updated == [(103, "locked accounts see a support link")]
+    assert len(testrail.posted) == 3
+    assert tracked("QA-1")["locked accounts see a support link"] == [103]
@@ -0,0 +1,159 @@
+import io
+import re
+import json
+import logging
+import xml.etree.ElementTree as ET
+from typing import Iterable, List, Optional, Tuple
+
+logging.basicConfig(level=logging.INFO, filename="log.log")
+logger = logging.getLogger(__name__)
+
+# TestRail default statuses: 1 Passed, 2 Blocked, 3 Untested, 4 Retest, 5 Failed
+STATUS_IDS = {
+    "passed": 1,
+    "skipped": 2,
+    # pytest: an expected failure is a known, still open defect, not a pass
+    "xfailed": 2,
+    "xpassed": 1,
+    "blocked": 2,
+    "untested": 3,
+    "retest": 4,
+    "failed": 5,
+    "error": 5,
+}
+# When a case is reported several times the worst result wins
+_SEVERITY = {1: 0, 3: 1, 4: 2, 2: 3, 5: 4}
+
+_CASE_ID = re.compile(r"(?<![A-Za-z0-9])C(\d+)(?!\d)")
+_CASE_ID_PROPERTIES = ("testrail_case_id", "case_id", "test_id")
+
+
+def _case_id_from(*texts: Optional[str]) -> Optional[int]:
+    for text in texts:
+        if text:
+            match = _CASE_ID.search(text)
+            if match:
+                return int(match.group(1))
+    return None
+
+
+def _elapsed(seconds) -> Optional[str]:
+    # TestRail rejects elapsed values below one second
+    try:
+        seconds = float(seconds)
+    except (TypeError, ValueError):
+        return None
+    return f"{max(1, round(seconds))}s" if seconds > 0 else None
+
+
+def _result(case_id: int, outcome: str, comment: str = "", elapsed=None) -> dict:
+    result = {"case_id": case_id, "status_id": STATUS_IDS.get(outcome, STATUS_IDS["failed"])}
+    if comment:
+        result["comment"] = comment[:4000]
+    elapsed = _elapsed(elapsed)
+    if elapsed:
+        result["elapsed"] = elapsed
+    return result
+
+
+def parse_junit_results(data: bytes) -> Iterable[Tuple[Optional[int], dict]]:
+    """
+    Incrementally parse a JUnit XML report.
+
+    Yields (case_id, result) per <testcase>; case_id is taken from a
+    `testrail_case_id` property or a "C123" marker in the test name and is
+    None when the test is not mapped to a TestRail case.
+    """
+    for _, element in ET.iterparse(io.BytesIO(data), events=("end",)):
+        if element.tag != "testcase":
+            continue
+        case_id = None
+        for prop in element.iter("property"):
+            value = (prop.get("value") or "").lstrip("Cc")
+            if prop.get("name") in _CASE_ID_PROPERTIES and value.isdigit():
+                case_id = int(value)
+                break
+        if case_id is None:
+            case_id = _case_id_from(element.get("name"), element.get("classname"))
+
+        outcome, comment = "passed", ""
+        for tag in ("failure", "error", "skipped"):
+            child = element.find(tag)
+            if child is not None:
+                outcome = "failed" if tag == "failure" else tag
+                comment = "\n".join(filter(None, [child.get("message"), (child.text or "").strip()]))
+                break
+        yield case_id, _result(case_id, outcome, comment, element.get("time"))
+        # Keep memory flat on large reports
+        element.clear()
+
+
+def _parse_case_id(value) -> Optional[int]:
+    # "C123", "123" or 123; anything else counts as unmapped
+    try:
+        return int(str(value).strip().lstrip("Cc"))
+    except ValueError:
+        return None
+
+
+def parse_json_results(data: bytes) -> Iterable[Tuple[Optional[int], dict]]:
+    """
+    Parse JSON test results.
+
+    Supported shapes: pytest-json-report (`{"tests": [...]}` with nodeid and
+    outcome), a list or `{"results": [...]}` of
+    `{"case_id", "status" | "status_id", "comment", "elapsed"}`, and the same
+    objects as newline-delimited JSON for streamed results.
+    """
+    text = data.decode("utf-8")
+    try:
+        payload = json.loads(text)
+        if isinstance(payload, dict) and ("case_id" in payload or "nodeid" in payload):
+            # A single result, e.g. a one-line NDJSON stream
+            items = [payload]
+        elif isinstance(payload, dict):
+            items = payload.get("tests") or payload.get("results") or []
+        else:
+            items = payload
+    except json.JSONDecodeError:
+        items = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    for item in items:
+        if "nodeid" in item:
+            case_id = _case_id_from(item.get("nodeid"))
+            longrepr = (item.get("call") or item.get("setup") or {}).get("longrepr", "")
+            yield case_id, _result(case_id, item.get("outcome", "failed"), str(longrepr or ""), item.get("duration"))
+            continue
+        raw_case_id = item.get("case_id")
+        case_id = _parse_case_id(raw_case_id) if raw_case_id is not None else _case_id_from(item.get("name"))
+        if "status_id" in item:
+            result = {"case_id": case_id, "status_id": int(item["status_id"])}
+            if item.get("comment"):
+                result["comment"] = item["comment"]
+            if item.get("elapsed"):
+                result["elapsed"] = item["elapsed"]
+            yield case_id, result
+        else:
+            yield case_id, _result(case_id, str(item.get("status", "failed")).lower(), item.get("comment", ""), item.get("elapsed"))
+
+
+def collect_results(data: bytes, content_type: str = "") -> Tuple[List[dict], int]:
+    """
+    Parse a JUnit XML or JSON result file into TestRail results.
+
+    Returns the results (one per case, the worst outcome wins) and the number
+    of tests that could not be mapped to a case id.
+    """
+    is_xml = "xml" in content_type or data.lstrip()[:1] == b"<"
+    parser = parse_junit_results if is_xml else parse_json_results
+    by_case, unmapped = {}, 0
+    for case_id, result in parser(data):
+        if case_id is None:
+            unmapped += 1
+            continue
+        current = by_case.get(case_id)
+        if current is None or _SEVERITY.get(result["status_id"], 0) >= _SEVERITY.get(current["status_id"], 0):
+            by_case[case_id] = result
+    if unmapped:
+        logger.warning(f"{unmapped} test results could not be mapped to a TestRail case id")
+    return list(by_case.values()), unmapped
@@ -0,0 +1,66 @@
+import json
+
+from test_results import collect_results
+
+JUNIT = b"""<?xml version="1.0" encoding="utf-8"?>
+<testsuites>
+  <testsuite name="api">
+    <testcase classname="tests.test_login" name="test_C101_valid_login" time="1.5"/>
+    <testcase classname="tests.test_login" name="test_wrong_password">
+      <properties><property name="testrail_case_id" value="C102"/></properties>
+      <failure message="assert 401 == 200">Traceback</failure>
+    </testcase>
+    <testcase classname="tests.test_login" name="test_C101_valid_login_again">
+      <skipped message="flaky"/>
+    </testcase>
+    <testcase classname="tests.test_misc" name="test_unmapped"/>
+  </testsuite>
+</testsuites>
+"""
+
+
+def by_case(results):
+    return {result["case_id"]: result for result in results}
+
+
+def test_junit_maps_case_ids_and_keeps_the_worst_outcome():
+    results, unmapped = collect_results(JUNIT, "application/xml")
+
+    results = by_case(results)
+    assert unmapped == 1
+    assert results[101]["status_id"] == 2  # skipped outranks the earlier pass
+    assert results[102]["status_id"] == 5
+    assert results[102]["comment"] == "assert 401 == 200\nTraceback"
+
+
+def test_pytest_json_report_outcomes():
+    report = {"tests": [
+        {"nodeid": "tests/test_a.py::test_C201", "outcome": "passed", "duration": 2.1},
+        {"nodeid": "tests/test_a.py::test_C202", "outcome": "xfailed"},
+        {"nodeid": "tests/test_a.py::test_C203", "outcome": "xpassed"},
+        {"nodeid": "tests/test_a.py::test_C204", "outcome": "failed", "call": {"longrepr": "boom"}},
+    ]}
+
+    results, unmapped = collect_results(json.dumps(report).encode())
+
+    results = by_case(results)
+    assert unmapped == 0
+    assert {case_id: r["status_id"] for case_id, r in results.items()} == {201: 1, 202: 2, 203: 1, 204: 5}
+    assert results[201]["elapsed"] == "2s"
+    assert results[204]["comment"] == "boom"
+
+
+def test_ndjson_with_a_single_line():
+    results, unmapped = collect_results(b'{"case_id": "C301", "status": "passed"}\n')
+
+    assert results == [{"case_id": 301, "status_id": 1}]
+    assert unmapped == 0
+
+
+def test_ndjson_bad_case_id_is_unmapped():
+    data = b'{"case_id": 302, "status_id": 5, "comment": "broken"}\n{"case_id": "n/a", "status": "passed"}\n'
+
+    results, unmapped = collect_results(data)
+
+    assert results == [{"case_id": 302, "status_id": 5, "comment": "broken"}]
+    assert unmapped == 1
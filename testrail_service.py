@@ -5,6 +5,7 @@ from fastapi import HTTPException
 from testrail_api import TestRailAPI
 from typing import List, Optional
 from pydantic import BaseModel
+from resilience import call_with_retry
 
 dotenv.load_dotenv()
 
@@ -17,6 +18,16 @@ api = TestRailAPI(
     os.getenv("TESTRAIL_EMAIL"),
     os.getenv("TESTRAIL_PASSWORD")
 )
+TESTRAIL_HOST = os.getenv("TESTRAIL_BASE_URL") or "testrail"
+
+# Where generated test cases are stored
+DEFAULT_PROJECT_ID = int(os.getenv("TESTRAIL_PROJECT_ID", "1047"))
+DEFAULT_SUITE_ID = int(os.getenv("TESTRAIL_SUITE_ID", "1409"))
+DEFAULT_SECTION_ID = int(os.getenv("TESTRAIL_SECTION_ID", "12172"))
+
+# Results per add_results_for_cases call and attempts per chunk
+RESULTS_CHUNK_SIZE = int(os.getenv("TESTRAIL_RESULTS_CHUNK_SIZE", "250"))
+RESULTS_RETRIES = int(os.getenv("TESTRAIL_RESULTS_RETRIES", "3"))
 
 # Pydantic model for input validation
 class StepSeparated(BaseModel):
@@ -36,6 +47,54 @@ class TestCasePayload(BaseModel):
     automation_type: int = 0
     custom_ispositive: int = 0  # Default to negative if not specified
 
+class GeneratedTestCase(BaseModel):
+    """
+    A test case as produced by the model, i.e. TestCasePayload without the
+    TestRail placement fields.
+    """
+    title: str
+    custom_steps: str = ""
+    custom_preconds: Optional[str] = None
+    priority_id: int = 2
+    type_id: Optional[int] = None
+    custom_steps_separated: Optional[List[StepSeparated]] = None
+    automation_type: int = 0
+    custom_ispositive: int = 0
+
+def generated_test_cases_schema() -> dict:
+    """
+    JSON schema for a top-level array of generated test cases, usable as Ollama `format`.
+    """
+    item_schema = GeneratedTestCase.model_json_schema()
+    # "#/$defs/..." references resolve against the root, so lift the definitions there
+    defs = item_schema.pop("$defs", {})
+    return {"type": "array", "items": item_schema, "$defs": defs}
+
+def build_test_case_payload(case: dict,
+                            project_id: int = DEFAULT_PROJECT_ID,
+                            suite_id: int = DEFAULT_SUITE_ID,
+                            section_id: int = DEFAULT_SECTION_ID) -> TestCasePayload:
+    """
+    Convert a test case dict generated by the model into a TestCasePayload.
+    """
+    custom_steps_separated = [
+        StepSeparated(content=step["content"], expected=step.get("expected", ""))
+        for step in case.get("custom_steps_separated") or []
+    ]
+    return TestCasePayload(
+        project_id=project_id,
+        suite_id=suite_id,
+        section_id=section_id,
+        title=case.get("title"),
+        custom_steps=case.get("custom_steps", ""),
+        custom_steps_separated=custom_steps_separated,
+        automation_type=case.get("automation_type", 0),
+        custom_preconds=case.get("custom_preconds", None),
+        custom_ispositive=case.get("custom_ispositive", 0),
+        priority_id=case.get("priority_id", 2),
+        type_id=case.get("type_id", None)
+    )
+
 def post_test_case_to_testrail(payload: TestCasePayload):
     """
     Post a test case to TestRail using the add_case API endpoint via TestRailAPI SDK.
@@ -50,7 +109,8 @@ def post_test_case_to_testrail(payload: TestCasePayload):
     )
 
     try:
-        response = api.cases.add_case(
+        response = call_with_retry(
+            TESTRAIL_HOST, api.cases.add_case, idempotent=False,
             section_id=payload.section_id or payload.suite_id,
             title=payload.title,
             custom_steps=payload.custom_steps,
@@ -68,16 +128,51 @@ def post_test_case_to_testrail(payload: TestCasePayload):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-def create_test_run(project_id: int, suite_id: int, run_name: str):
+def update_test_case_in_testrail(case_id: int, payload: TestCasePayload):
+    """
+    Update an existing TestRail test case with the content of the payload.
+    """
+    steps_separated = (
+        [step.model_dump() for step in payload.custom_steps_separated]
+        if payload.custom_steps_separated else None
+    )
+
+    try:
+        response = call_with_retry(
+            TESTRAIL_HOST, api.cases.update_case,
+            case_id=case_id,
+            title=payload.title,
+            custom_steps=payload.custom_steps,
+            custom_steps_separated=steps_separated,
+            custom_preconds=payload.custom_preconds,
+            priority_id=payload.priority_id,
+            type_id=payload.type_id,
+            custom_automation_type=payload.automation_type,
+            custom_ispositive=payload.custom_ispositive
+        )
+        logger.info(f"Test case {case_id} updated successfully: {response}")
+        return response
+    except Exception as e:
+        logger.error(f"Failed to update test case {case_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def create_test_run(project_id: int, suite_id: int, run_name: str, case_ids: Optional[List[int]] = None):
     """
     Create a new test run in TestRail.
+
+    If case_ids is given the run contains only those cases, otherwise all cases of the suite.
     """
+    run_fields = {"include_all": True}
+    if case_ids is not None:
+        run_fields = {"include_all": False, "case_ids": case_ids}
     try:
-        response = api.runs.add_run(
+        response = call_with_retry(
+            TESTRAIL_HOST, api.runs.add_run, idempotent=False,
             project_id=project_id,
             suite_id=suite_id,
             name=run_name,
-            include_all=True
+            **run_fields
         )
         logger.info(f"Test run created successfully: {response}")
         return response
@@ -91,7 +186,8 @@ def add_test_result(run_id: int, case_id: int, status_id: int, comment: str = ""
     Add a result for a test case in a test run.
     """
     try:
-        response = api.results.add_result_for_case(
+        response = call_with_retry(
+            TESTRAIL_HOST, api.results.add_result_for_case, idempotent=False,
             run_id=run_id,
             case_id=case_id,
             status_id=status_id,
@@ -103,12 +199,37 @@ def add_test_result(run_id: int, case_id: int, status_id: int, comment: str = ""
         logger.error(f"Failed to add test result: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
     
+def add_test_results(run_id: int, results: List[dict], chunk_size: int = RESULTS_CHUNK_SIZE,
+                     retries: int = RESULTS_RETRIES) -> dict:
+    """
+    Add results for many cases of a test run with batched add_results_for_cases calls.
+
+    A chunk is only retried when TestRail cannot have stored it (connection
+    refused, 429), since a repeated add_results_for_cases adds every result
+    again. Chunks that still fail are reported back instead of aborting the
+    remaining ones.
+    """
+    posted, failed_chunks = 0, []
+    for start in range(0, len(results), chunk_size):
+        chunk = results[start:start + chunk_size]
+        try:
+            call_with_retry(
+                TESTRAIL_HOST, api.results.add_results_for_cases, idempotent=False,
+                run_id=run_id, results=chunk, attempts=retries
+            )
+            posted += len(chunk)
+        except Exception as e:
+            logger.error(f"Failed to add results {start}-{start + len(chunk)} to run {run_id}: {str(e)}")
+            failed_chunks.append({"offset": start, "size": len(chunk), "error": str(e)})
+    logger.info(f"Added {posted}/{len(results)} results to run {run_id}")
+    return {"run_id": run_id, "posted": posted, "failed_chunks": failed_chunks}
+
 def get_testrail_case(case_id: int):
     """
     Retrieve a test case from TestRail by its ID.
     """
     try:
-        response = api.cases.get_case(case_id)
+        response = call_with_retry(TESTRAIL_HOST, api.cases.get_case, case_id)
         logger.info(f"Test case retrieved successfully: {response}")
         return response
     except Exception as e: